@@ -2,49 +2,300 @@ from frontier import FrontierBestFirstWidth
 from heuristic import HeuristicBFWS
 from graphsearch import search
 from action import Action
-import copy
-from conflictmodule import validate, add_constraint
+from heapq import heappush, heappop
+from itertools import combinations
+from collections import OrderedDict
+import time
+from conflictmodule import Constraint, find_conflicts, pair_conflict, get_constraint
+from state import State
+from mdd import MDD
+import parallel
+import sipp
+
+# Break low-level ties with a conflict avoidance table of the other paths, set from the command line
+conflict_avoidance = False
+
+# Split on cardinal conflicts first and bypass same-cost children (ICBS), set from the command line
+cardinal_conflicts = False
+
+# Add the minimum vertex cover of the cardinal conflict graph to the node cost (CBSH), set from the command line
+cardinal_heuristic = False
+
+# Replan a child from its parent's path shortly before the new constraint instead of from the start, set from the command line
+plan_repair = False
+
+# Entries of the LRU cache of low-level plans, set from the command line (0 to disable)
+plan_cache_size = 1024
+
+# Steps of the parent's path given back to the repair search before the time of the new constraint
+repair_window = 2
+
+def low_level_search(state, constraints, avoid = (), prefix = (), bound = None):
+    '''
+    Plans one worker from its initial state under its constraints, returns (plan, trajectory).
+    With a prefix (joint actions of the parent's plan that the constraints still allow), the prefix is
+    replayed and only the rest of the plan is searched. The whole search runs if that fails or if the
+    repaired plan is longer than bound (the length of the parent's plan).
+    Agent-only workers are planned with SIPP when it is enabled, the conflict avoidance paths and the prefix do not apply there.
+    It runs in the main process or in a pool worker, so it only depends on its arguments and the static level data.
+    '''
+    if sipp.enabled and not state.boxes:
+        return sipp.plan(state, constraints)
+    state.set_constraints(constraints, avoid)
+    start = state
+    for joint_action in prefix:
+        # A prefix that does not apply or breaks a constraint is dropped, the whole search runs instead
+        if not all(start.is_applicable(agent, action) for agent, action in enumerate(joint_action)):
+            start = state
+            break
+        start = start.result(joint_action)
+        if start.constraint_step:
+            start = state
+            break
+    repaired = None
+    if start is not state:
+        State._RNG.seed(1)
+        repaired = search(start, FrontierBestFirstWidth(HeuristicBFWS(state)))
+        if repaired is None or repaired[0] is None:
+            repaired = None
+        elif bound is None or len(repaired[0]) <= bound:
+            return repaired
+    State._RNG.seed(1)      # Same successor shuffle whatever ran before, in this process or another one
+    frontier = FrontierBestFirstWidth(HeuristicBFWS(state))
+    result = search(state, frontier)
+    # A detour kept from the repair is still better than no plan
+    if repaired is not None and (result is None or result[0] is None):
+        return repaired
+    return result
+
+class PlanCache:
+    '''
+    Bounded LRU cache of low-level results, keyed by the agent, its constraints and the replayed prefix.
+    The low-level search is deterministic in its arguments, so a hit returns the plan a search would find.
+    '''
+    def __init__(self, max_size: 'int'):
+        self.max_size = max_size
+        self.entries = OrderedDict()    # Key -> (plan, trajectory), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(node, args):
+        # None when the result depends on the paths of the other agents (conflict avoidance), such searches are not cached
+        state, constraints, avoid, prefix, bound = args
+        if avoid:
+            return None
+        return (state.worker_name, frozenset(node.constraint_to_tuple(constraint) for constraint in constraints),
+                tuple(tuple(joint_action) for joint_action in prefix), bound)
+
+    def get(self, key):
+        if key is None or self.max_size <= 0:
+            return None
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        if key is None or self.max_size <= 0:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return 'size: {} hits: {} misses: {} hit rate: {:.1%}'.format(len(self.entries), self.hits, self.misses, self.hits / lookups if lookups else 0.0)
 
 class Node():
 
-    def __init__(self, states, single_agent = None, constraints = []):
+    def __init__(self, states, parent = None, agent = None, constraint = None):
+        '''
+        A node of the constraint tree. Children only store the constraint they add and the plan of the
+        replanned agent, the constraints above them are reached through the parent pointer and the plans
+        of the other agents are shared with the parent.
+        '''
         self.initial_states = states
-        self.constraints = constraints
-        self.agent = None
-        self.boxes = []
-        if single_agent is not None:
-            # Select worker for a singleton search
-            state = next((state for state in self.initial_states if state.worker_name == single_agent), None)
-            state = [state]
-            self.plans, self.paths = self.plans_from_states(state) # Has to be consistent with constraints
-            state[0].constraints = self.constraints
-        else:
-            for state in self.initial_states:
-                state.constraints = [constraint for constraint in self.constraints if constraint.agent == state.worker_name]
-            self.plans, self.paths = self.plans_from_states(self.initial_states)     # Has to be consistent with constraints
+        self.parent = parent
+        self.agent = agent
+        self.constraint = constraint
         self.workers = [state.worker_name for state in self.initial_states]
-        self.cost = sum([len(plan) for plan in self.plans]) # sum of costs
+        self.conflicts = None       # (i, j) -> first conflict of path i against path j, filled when the node is opened
+        self.mdds = {}              # Agent -> MDD at the cost of its path, for the agent-only workers
+        if parent is None:
+            self.plans, self.paths = self.plans_from_states(self.initial_states)
+            self.depth = 0
+            self.fingerprint = frozenset()
+            self.sum_of_costs = sum([len(plan) for plan in self.plans])
+            self.priority = 0
+            self.cost = self.get_cost()
+        else:
+            self.plans, self.paths = parent.plans, parent.paths     # Shared until set_plan()
+            self.depth = parent.depth + 1
+            self.fingerprint = parent.fingerprint | {self.constraint_to_tuple(constraint)}
+            self.sum_of_costs = parent.sum_of_costs
+            self.priority = parent.priority
+            self.cost = parent.cost
+
+    @property
+    def constraints(self):
+        # Walk up the tree, the root has no constraint
+        constraints = []
+        node = self
+        while node.parent is not None:
+            constraints.append(node.constraint)
+            node = node.parent
+        constraints.reverse()
+        return constraints
+
+    def set_plan(self, plan, path, priority) -> 'bool':
+        ''' Stores the replanned plan of the agent of the node. Returns False if it has no plan. '''
+        if plan is None:
+            return False
+        # Copy on write: only the lists of references are new, the plans of the other agents are shared
+        self.plans = list(self.plans)
+        self.paths = list(self.paths)
+        self.plans[self.agent] = plan
+        self.paths[self.agent] = path
+        self.sum_of_costs = sum([len(plan) for plan in self.plans])
+        self.priority = priority
+        self.cost = self.get_cost()
+        return True
+
+    def get_cost(self):
+        '''
+        Cost key of the open list: (priority of the replanned agent, sum of costs, number of constraints).
+        With CBSH the nodes are expanded best-first on sum of costs + heuristic, the ties go to the
+        shallower node, then to the agent priority.
+        '''
+        if cardinal_heuristic:
+            return (self.sum_of_costs + self.get_heuristic(), self.depth, self.priority)
+        return (self.priority, self.sum_of_costs, self.depth)
+
+    def get_heuristic(self) -> 'int':
+        '''
+        CBSH: size of a minimum vertex cover of the graph of the agents with a cardinal conflict between them.
+        Each edge raises the cost of one of its agents, so the cover is a lower bound on the cost still to pay.
+        '''
+        if not cardinal_heuristic:
+            return 0
+        conflicts = self.get_conflicts()
+        edges = {tuple(sorted(pair)) for pair, conflict in conflicts.items() if self.get_cardinality(conflict) == 0}
+        agents = sorted({agent for edge in edges for agent in edge})
+        # At most 10 agents, trying the covers by increasing size is cheap
+        for size in range(len(agents) + 1):
+            for cover in combinations(agents, size):
+                if all(i in cover or j in cover for i, j in edges):
+                    return size
+        return 0
+
+    def get_conflicts(self):
+        '''
+        The conflict table of the node. A child only changed the path of its agent, so it inherits
+        the pairs of its parent that do not involve that agent and compares the new path with the others.
+        '''
+        if self.conflicts is None:
+            if self.parent is None:
+                self.conflicts = find_conflicts(self.paths)
+            else:
+                self.conflicts = dict(self.parent.get_conflicts())
+                self.update_conflicts(self.agent)
+        return self.conflicts
+
+    def update_conflicts(self, agent):
+        # Recompute the pairs involving agent after its path changed
+        self.conflicts = {pair: conflict for pair, conflict in self.conflicts.items() if agent not in pair}
+        path = self.paths[agent]
+        for other, other_path in enumerate(self.paths):
+            if other == agent or other_path is None or len(other_path) == 0:
+                continue
+            for pair, conflict in (((agent, other), pair_conflict(path, other_path)), ((other, agent), pair_conflict(other_path, path))):
+                if conflict is not None:
+                    self.conflicts[pair] = conflict
+
+    def get_mdd(self, agent):
+        # The parent's MDD still holds when neither the path nor the constraints of the agent changed
+        if agent not in self.mdds:
+            parent = self.parent
+            if parent is not None and agent != self.agent and agent in parent.mdds and parent.paths[agent] is self.paths[agent]:
+                self.mdds[agent] = parent.mdds[agent]
+            else:
+                state, constraints = self.get_search_args(agent)[:2]
+                self.mdds[agent] = MDD(state, constraints, len(self.plans[agent]))
+        return self.mdds[agent]
+
+    def get_cardinality(self, conflict) -> 'int':
+        '''
+        0 for a cardinal conflict (the constraint of every agent raises its cost), 1 for a semi-cardinal
+        and 2 for a non-cardinal one. MDDs only exist for agent-only workers, the other conflicts are non-cardinal.
+        '''
+        cardinal = 0
+        for agent in conflict.agents:
+            constraint = get_constraint(conflict, agent)
+            if agent is None or constraint is None:
+                continue
+            if not isinstance(constraint, Constraint) or self.get_search_args(agent)[0].boxes:
+                return 2
+            if self.get_mdd(agent).is_singleton(constraint.loc_to, constraint.time):
+                cardinal += 1
+        return 2 - min(cardinal, 2)
+
+    def get_best_conflict(self):
+        # Cardinal conflicts first, then the order of validating the paths: first path, first path it conflicts with
+        conflicts = self.get_conflicts()
+        if not conflicts:
+            return None
+        if not cardinal_conflicts:
+            return conflicts[min(conflicts)]
+        return conflicts[min(conflicts, key=lambda pair: (self.get_cardinality(conflicts[pair]), pair))]
+
+    def adopt(self, child):
+        ''' Bypass: takes the path of a child of the same cost instead of branching, the constraints stay the same '''
+        self.plans, self.paths = child.plans, child.paths
+        self.conflicts = child.get_conflicts()
+        self.mdds.pop(child.agent, None)
+        self.cost = self.get_cost()     # The conflict graph changed, and so did the heuristic
 
     def plans_from_states(self, states):
 
         plans = []
         plans_repr = []
-        for state in states:
-            frontier = FrontierBestFirstWidth(HeuristicBFWS(state))
-            searching = search(state, frontier)
-            plan, plan_repr = searching
+        pool = parallel.get_pool()
+        if pool is None or len(states) < 2:
+            results = [low_level_search(state, []) for state in states]
+        else:
+            # One unconstrained search per worker, the level tables are already in the pool workers
+            results = pool.map(low_level_search, states, [[] for _ in states])
+        for plan, plan_repr in results:
             plans.append(plan)
             plans_repr.append(plan_repr)
         
         return plans, plans_repr
 
-    def get_single_search(self, single_agent):
+    def get_search_args(self, single_agent):
 
         state = next((state for state in self.initial_states if state.worker_name == single_agent), None)
-        state.constraints = self.constraints
-        state = [state]
-        return self.plans_from_states(state)
-    
+        # Only the constraints of this agent, compiled once into the reservation table of its search
+        constraints = [constraint for constraint in self.constraints if constraint.agent == single_agent]
+        avoid = [path for other, path in enumerate(self.paths) if other != single_agent and path is not None and len(path) > 0] if conflict_avoidance else []
+        return (state, constraints, avoid) + self.get_repair_prefix(single_agent)
+
+    def get_repair_prefix(self, single_agent):
+        '''
+        (prefix, bound): the part of the parent's plan of the replanned agent that comes before the new constraint,
+        and the length of that plan. The parent's path respects every other constraint of the agent, so only
+        the search after the prefix is redone.
+        '''
+        if not plan_repair or self.parent is None or single_agent != self.agent:
+            return [], None
+        cut = max(0, self.constraint.time - repair_window)
+        plan = self.parent.plans[self.workers.index(single_agent)]
+        return plan[:cut], len(plan)
+
     def get_constraints_tuple(self):
         # Convert each constraint into a tuple based on its properties
         return tuple(self.constraint_to_tuple(constraint) for constraint in self.constraints)
@@ -57,119 +308,108 @@ class Node():
             return (constraint.agent, constraint.loc_to, constraint.time)
         
     def agents_to_rest(self):
+        # Pads the shorter plans with NoOps into new lists, the plans may be shared with other nodes
         longest = max([len(plan) for plan in self.plans])
-        result_plans = [plan for plan in self.plans if len(plan) == longest]
-        filtered_plans = [plan for plan in self.plans if len(plan) < longest]
-        if len(filtered_plans) > 0:
-            for plan in  filtered_plans:
-                len_diff = longest - len(plan)
-                plan += [[Action.NoOp]] * len_diff
-                result_plans.append(plan)
-        return result_plans
-    
-    def __hash__(self):
-        plan_tuple = tuple(tuple(tuple(action) for action in plan) for plan in self.plans)
-        constraints_tuple = self.get_constraints_tuple()
-        return hash((self.agent, constraints_tuple, plan_tuple))
-    
-    def __eq__(self, other):
-        if not isinstance(other, type(self)):
-            return False
-        return (self.agent == other.agent and
-                self.constraints == other.constraints and
-                self.plans == other.plans)
+        return [plan + [[Action.NoOp]] * (longest - len(plan)) for plan in self.plans]
 
 def CBS(initial_states):
 
     is_single = False
+    start_time = time.perf_counter()
+    # The plans of the nodes are indexed by worker name, and the joint actions list the agents in that order
+    initial_states = sorted(initial_states, key=lambda state: state.worker_name)
     root = Node(initial_states)
     root.agent = None
-    open_set = set()
-    open_set.add(root)
-    closed_set = set()
+    print("#Time to first root: {:.3f} s for {} agents".format(time.perf_counter() - start_time, len(root.plans)), flush=True)
+    # Heap of (cost, counter, node): the counter breaks ties in insertion order and keeps nodes out of the comparison
+    open_list = [(root.cost, 0, root)]
+    counter = 1
+    closed_set = set()          # Fingerprints of the expanded nodes
     iterations = 0
     priority_lookup = {}
     C = None
+    bypasses = 0
+    pool = parallel.get_pool()
+    cache = PlanCache(plan_cache_size)
     
     for worker in root.workers:
         priority_lookup[worker] = len(root.plans[worker])
 
-    while open_set:
+    while open_list:
         iterations += 1
-        filtered_set = [p for p in open_set if p not in closed_set]
-        P = min(filtered_set, key=lambda x: (x.cost))
-        open_set.remove(P)
-        closed_set.add(P)
+        _, _, P = heappop(open_list)
+        if P.fingerprint in closed_set:
+            continue
+        closed_set.add(P.fingerprint)
 
-        print("#Opening node with cost", P.cost, "agent", P.agent, "No of Constraint of the node:", len(P.constraints),\
-            "explored nodes", len(closed_set), "frontier size", len(filtered_set), "Longest path:", len(P.paths[0]), flush=True)
+        print("#Opening node with cost", P.cost, "agent", P.agent, "No of Constraint of the node:", P.depth,\
+            "explored nodes", len(closed_set), "frontier size", len(open_list), "Longest path:", len(P.paths[0]), flush=True)
         
-        for path in P.paths:
-            C = validate(path, P.paths) # Consistent path needs to be valid
-            if C is not None:   # Found conflict, path invalid, non goal node
-                break
+        C = P.get_best_conflict()       # Consistent paths need to be valid, None is a goal node
 
         # Found solution
         if not C:
             ("Found solution")
+            print("#CT nodes expanded:", len(closed_set), "bypasses:", bypasses, "conflict avoidance", "on" if conflict_avoidance else "off", flush=True)
+            print("#Plan cache", cache, flush=True)
             if len(P.plans) == 1:
                 solution = P.plans[0]
                 is_single = True
             else:
-                P.agents_to_rest()
-                solution = [x for x in zip(*P.plans)]
+                solution = [x for x in zip(*P.agents_to_rest())]
             return solution, is_single
         
         # Deal with one conflict at a time
+        children = []
         for i, agent_i in enumerate(C.agents):
 
             if agent_i is None:
                 continue
             
             else:
-                A = copy.deepcopy(P)
-                A.agent = agent_i
-                
                 # Add constraint
 
-                A = add_constraint(C, A, agent_i)
-                if A == None:
+                constraint = get_constraint(C, agent_i)
+                if constraint is None:
                     continue
 
-                # Replan
-                
-                plan_i, path_i = A.get_single_search(agent_i)
-                plan_i = plan_i[0]
-                path_i = path_i[0]
-
-                if plan_i is None:
+                A = Node(P.initial_states, P, agent_i, constraint)
+                # A constraint the node already has, or a constraint set already expanded: skip the replan
+                if A.fingerprint == P.fingerprint or A.fingerprint in closed_set:
                     continue
-                
-                A.plans[agent_i] = plan_i
-                A.paths[agent_i] = path_i
-
-                # Get cost
-                plan_lengths = [len(plan) for plan in A.plans]
-                A.cost = (priority_lookup[agent_i], sum(plan_lengths), len(A.constraints))
-                
-                #removing duplicates:
-                unique_constraints = set()
-                new_constraints_list = []
-
-                for constraint in A.constraints:
-                    # Check if the constraint is a BoxConstraint and adjust the tuple to include the box
-                    if hasattr(constraint, 'box'):
-                        constraint_key = (constraint.agent, constraint.loc_to, constraint.time, constraint.box)
-                    else:
-                        constraint_key = (constraint.agent, constraint.loc_to, constraint.time)
-                    
-                    # Add to the new list only if the tuple is not in the set
-                    if constraint_key not in unique_constraints:
-                        unique_constraints.add(constraint_key)
-                        new_constraints_list.append(constraint)
-
-                A.constraints = new_constraints_list
-
-                open_set.add(A)
+                children.append(A)
+
+        # Replan, the cached plans first, the other children searches run concurrently in the pool
+        search_args = [A.get_search_args(A.agent) for A in children]
+        keys = [PlanCache.get_key(A, args) for A, args in zip(children, search_args)]
+        results = [cache.get(key) for key in keys]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if pool is None or len(missing) < 2:
+            searched = [low_level_search(*search_args[index]) for index in missing]
+        else:
+            searched = pool.map(low_level_search, *zip(*[search_args[index] for index in missing]))
+        for index, result in zip(missing, list(searched)):
+            results[index] = result
+            if result is not None:
+                cache.put(keys[index], result)
+
+        # Results come back in the order of the children, so the open list is the same as a sequential run
+        children = [A for A, (plan_i, path_i) in zip(children, list(results)) if A.set_plan(plan_i, path_i, priority_lookup[A.agent])]
+
+        # Bypass: a child as cheap as P with fewer conflicts replaces the path in P, and P is opened again
+        bypass = None
+        if cardinal_conflicts:
+            bypass = next((A for A in children if A.sum_of_costs == P.sum_of_costs and len(A.get_conflicts()) < len(P.get_conflicts())), None)
+        if bypass is not None:
+            P.adopt(bypass)
+            closed_set.discard(P.fingerprint)
+            heappush(open_list, (P.cost, counter, P))
+            counter += 1
+            bypasses += 1
+            continue
+
+        for A in children:
+            heappush(open_list, (A.cost, counter, A))
+            counter += 1
 
     return None
\ No newline at end of file
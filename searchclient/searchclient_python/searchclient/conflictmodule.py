@@ -1,4 +1,4 @@
-from utils import match_length
+import numpy as np
 
 ''' Defining Conflicts '''
 
@@ -129,10 +129,124 @@ class BoxConstraint:
     def __hash__(self):
         return hash((self.agent, self.box, self.loc_to, self.time))
 
+class ReservationTable:
+    ''' Constraints of one low-level search, compiled into per time step sets of blocked cells '''
+    def __init__(self, constraints, num_cols, avoid = ()):
+        self.agent_cells = {}       # time -> cells the agent may not occupy
+        self.box_cells = {}         # time -> cells no box may occupy
+        self.horizon = 0            # Last constrained time step
+        self.avoidance = ConflictAvoidanceTable(avoid, num_cols) if avoid else None
+        for constraint in constraints:
+            cell = constraint.loc_to[0] * num_cols + constraint.loc_to[1]
+            if isinstance(constraint, BoxConstraint):
+                self.box_cells.setdefault(constraint.time, set()).add(cell)
+            else:
+                self.agent_cells.setdefault(constraint.time, set()).add(cell)
+            self.horizon = max(self.horizon, constraint.time)
+
+class ConflictAvoidanceTable:
+    '''
+    Soft counterpart of the reservation table: how many conflicts a position would have with the
+    current paths of the other agents. The same vertex and follow matches big_validation counts.
+    '''
+    def __init__(self, plan_list, num_cols):
+        length = max(len(plan) for plan in plan_list)
+        occupied = [{} for _ in range(length)]         # time -> cell -> entities of the other paths on it
+        for plan in plan_list:
+            positions = plan.padded(length).astype(np.int64)
+            for t, cells in enumerate((positions[:, :, 0] * num_cols + positions[:, :, 1]).tolist()):
+                for cell in cells:
+                    occupied[t][cell] = occupied[t].get(cell, 0) + 1
+        # A cell entered at t conflicts with the entities on it at t and the ones that left it at t - 1
+        self.steps = [occupied[0]]
+        for t in range(1, length):
+            step = dict(occupied[t])
+            for cell, count in occupied[t - 1].items():
+                step[cell] = step.get(cell, 0) + count
+            self.steps.append(step)
+
+    def count(self, time, agents, boxes) -> 'int':
+        # The other agents wait at the end of their paths
+        step = self.steps[min(time, len(self.steps) - 1)]
+        count = 0
+        for cell in agents:
+            count += step.get(cell, 0)
+        for cell, _ in boxes:
+            count += step.get(cell, 0)
+        return count
+
 ''' Utils '''
 
 # Used in here in the validation functions
 
+def position(plan, t, column):
+    # Shorter plans wait at their last step
+    return tuple(int(x) for x in plan.positions[min(t, len(plan) - 1), column])
+
+def pair_matches(plan, other_plan):
+    """
+    Vectorized comparison of two trajectories padded to the same length T. Returns two boolean arrays
+    of shape (T - 1, entities of plan, entities of other_plan), for the time steps t = 1 .. T - 1:
+    vertex when an entity of plan is on the cell of an entity of other_plan at t,
+    follow when it is on the cell the entity of other_plan occupied at t - 1.
+    """
+    length = max(len(plan), len(other_plan))
+    cells = plan.cells(length)
+    other_cells = other_plan.cells(length)
+    vertex = cells[1:, :, None] == other_cells[1:, None, :]
+    follow = cells[1:, :, None] == other_cells[:-1, None, :]
+    return vertex, follow
+
+def step_matches(cells, other_cells, t):
+    # pair_matches for the single time step t, from the packed cells of the two plans
+    return cells[t][:, None] == other_cells[t][None, :], cells[t][:, None] == other_cells[t - 1][None, :]
+
+def conflict_at(plan, other_plan, t, vertex, follow):
+    """
+    Builds the conflict of plan against other_plan at time t from the matches of that step (column 0
+    is the agent, the others the boxes). The checks go in the order: agent into agent, agent following
+    agent, box into box, agent into box, box into agent, agent following box, box following box
+    and box following agent. Within a check the boxes go in column order.
+    """
+    agent_i, agent_j = plan.agent, other_plan.agent
+
+    if vertex[0, 0]:
+        return Conflict(agent_i, agent_j, position(plan, t, 0), t)
+    if follow[0, 0]:
+        return AgentFollowConflict(agent_i, agent_j, position(plan, t, 0), t)
+
+    hits = np.argwhere(vertex[1:, 1:]) + 1
+    if len(hits):
+        box, other_box = hits[0]
+        return BoxConflict(agent_i, agent_j, plan.box_name(box), other_plan.box_name(other_box), position(plan, t, box), t)
+    hits = np.flatnonzero(vertex[0, 1:]) + 1
+    if len(hits):
+        return mixedConflict(agent_i, agent_j, other_plan.box_name(hits[0]), position(plan, t, 0), t)
+    hits = np.flatnonzero(vertex[1:, 0]) + 1
+    if len(hits):
+        return mixedConflict(agent_j, agent_i, plan.box_name(hits[0]), position(plan, t, hits[0]), t)
+
+    hits = np.flatnonzero(follow[0, 1:]) + 1
+    if len(hits):
+        return AgentBoxFollowConflict(agent_i, agent_j, other_plan.box_name(hits[0]), position(plan, t, 0), t, 0)
+    hits = np.argwhere(follow[1:, 1:]) + 1
+    if len(hits):
+        box, other_box = hits[0]
+        return BoxBoxFollowConflict(agent_i, agent_j, plan.box_name(box), other_plan.box_name(other_box), position(plan, t, box), t)
+    hits = np.flatnonzero(follow[1:, 0]) + 1
+    if len(hits):
+        return AgentBoxFollowConflict(agent_j, agent_i, plan.box_name(hits[0]), position(plan, t, hits[0]), t, 1)
+    return None
+
+def pair_conflict(plan, other_plan):
+    ''' Returns the first conflict of plan against other_plan, or None '''
+    vertex, follow = pair_matches(plan, other_plan)
+    steps = np.flatnonzero(vertex.any(axis=(1, 2)) | follow.any(axis=(1, 2)))
+    if len(steps) == 0:
+        return None
+    t = int(steps[0]) + 1
+    return conflict_at(plan, other_plan, t, vertex[t - 1], follow[t - 1])
+
 # Experimental feature
 
 def big_validation(node):
@@ -144,202 +258,108 @@ def big_validation(node):
 
         count = 0
 
-        for other_plan, other_worker in zip(plan_list, node.workers):
-            if plan == other_plan:
-                continue 
-            plan_copy, other_plan = match_length(plan, other_plan)
-            for j in range(1, len(plan)):
-                agent_state_current = plan_copy[j][0][1]
-
-                other_agent_state_current = other_plan[j][0][1]
-
-                other_agent_state_previous = other_plan[j - 1][0][1]
-                t=j
-
-                box_states_current = [state[1] for state in plan_copy[j][1:] if len(state) > 1]
-                box_states_current = [state[1] for state in plan_copy[j][1:] if len(state) > 1]
-                other_box_states_previous = [state[1] for state in other_plan[j - 1][1:] if len(state) > 1]
-                other_box_states_current = [state[1] for state in other_plan[j][1:] if len(state) > 1]
-                
-                if agent_state_current == other_agent_state_current:
-                    count += 1
-
-                # Follow conflict
-                if agent_state_current == other_agent_state_previous:
-                    count +=1
-                
-                # Box going into other Box
-                for idx, box_current in enumerate(box_states_current):
-                    count +=1
-
-                #Agent going into other box
-                for idx, other_box_current in enumerate(other_box_states_current):
-                    if agent_state_current == other_box_current:
-                        count +=1
-                
-                #Box going into other agent
-                for idx, box_current in enumerate(box_states_current):
-                    if box_current == other_agent_state_current:
-                        count +=1
-                
-                # Agent to Box Following
-
-                for idx, other_box_current in enumerate(other_box_states_previous):
-                    if agent_state_current == other_box_current:
-                        count +=1
-                
-                # Box to Box following
-                for idx, box_current in enumerate(box_states_current):
-                    for other_idx, other_box_current in enumerate(other_box_states_previous):
-                        count +=1
-                #Box to agent following
-                for idx, box_current in enumerate(box_states_current):
-                    if box_current == other_agent_state_previous:
-                        count +=1
+        for other_plan in plan_list:
+            if other_plan is plan:
+                continue
+            # Every vertex and follow match between the entities of the two plans
+            vertex, follow = pair_matches(plan, other_plan)
+            count += int(vertex.sum()) + int(follow.sum())
         
         priority[worker] = count
 
     return priority
 
-# Used in CBS line 109 - > C = validate(path, P.paths)
+# Used in CBS - > conflicts = find_conflicts(root.paths), children update theirs with pair_conflict
 
-def validate(plan, plan_list):
+def find_conflicts(plan_list):
     """
-    Generates constraints based on conflicts between the given plan and other plans in the plan_list,
-    including illegal crossings.
+    Single pass conflict detection over every plan at once. Each entity is looked up in an index of
+    the cells occupied at (cell, t) and at (cell, t-1), so the work is linear in the total plan length.
 
     Parameters:
-    - plan: The plan to validate for conflicts.
-    - plan_list: List of all plans to compare against.
+    - plan_list: List of all trajectories.
 
     Returns:
-    - Conflict: First conflict found during the validation process
+    - dict: (i, j) -> the first conflict of plan_list[i] against plan_list[j], the same one
+      pair_conflict(plan_list[i], plan_list[j]) finds. Pairs without conflict are left out.
     """
 
-    agent_i_full = plan[0][0][0]  # Something like 'AgentAt0'
-    agent_i = int(agent_i_full.split('AgentAt')[-1])
-    other_plans = [lst for lst in plan_list if lst is not plan]
-    for other_plan in other_plans:
-        if other_plan == [] or other_plan == []:
-            continue
-        agent_j_full = other_plan[0][0][0]
-        agent_j = int(agent_j_full.split('AgentAt')[-1])
-        # Ensure both plans are of equal length
-        plan_copy, other_plan = match_length(plan, other_plan)
-        for j in range(1, len(plan)):
-            # Get current and previous states for both plans
-            agent_state_current = plan_copy[j][0][1]
-
-            other_agent_state_current = other_plan[j][0][1]
-
-            other_agent_state_previous = other_plan[j - 1][0][1]
-            t=j
-
-            box_states_current = [state[1] for state in plan_copy[j][1:] if len(state) > 1]
-            box_names_current = [state[0].split('BoxAt')[-1] for state in plan_copy[j][1:] if len(state) > 1]
-            box_states_current = [state[1] for state in plan_copy[j][1:] if len(state) > 1]
-            box_names_current = [state[0].split('BoxAt')[-1] for state in plan_copy[j][1:] if len(state) > 1]
-            other_box_states_previous = [state[1] for state in other_plan[j - 1][1:] if len(state) > 1]
-            other_box_states_current = [state[1] for state in other_plan[j][1:] if len(state) > 1]
-            other_box_names_current = [state[0].split('BoxAt')[-1] for state in other_plan[j][1:] if len(state) > 1]
-
-            # Agent going into other agent
-            if agent_state_current == other_agent_state_current:
-                conflict = Conflict(agent_i, agent_j, agent_state_current, t)
-                return conflict
-
-            # Follow conflict
-            if agent_state_current == other_agent_state_previous:
-                conflict = AgentFollowConflict(agent_i, agent_j, agent_state_current, t)
-                return conflict
-            
-            # Box going into other Box
-            for idx, box_current in enumerate(box_states_current):
-                for other_idx, other_box_current in enumerate(other_box_states_current):
-                    if box_current == other_box_current:
-                        conflict = BoxConflict(agent_i, agent_j, box_names_current[idx], other_box_names_current[other_idx], box_current, t)
-                        return conflict
-                    
-            #Agent going into other box
-            for idx, other_box_current in enumerate(other_box_states_current):
-                if agent_state_current == other_box_current:
-                    conflict = mixedConflict(agent_i, agent_j, other_box_names_current[idx], other_box_current, t)
-                    return conflict
-            
-            # Box going into other agent
-            for idx, box_current in enumerate(box_states_current):
-                if box_current == other_agent_state_current:
-                    conflict = mixedConflict(agent_j, agent_i,box_names_current[idx], box_current, t)
-                    return conflict
-            
-            # Agent to Box Following
-            for idx, other_box_current in enumerate(other_box_states_previous):
-                if agent_state_current == other_box_current:
-                    conflict = AgentBoxFollowConflict(agent_i, agent_j, other_box_names_current[idx],  agent_state_current, t,0)
-                    return conflict
-
-            # Box to Box following
-            for idx, box_current in enumerate(box_states_current):
-                for other_idx, other_box_current in enumerate(other_box_states_previous):
-                    if box_current == other_box_current:
-                        return BoxBoxFollowConflict(agent_i, agent_j, box_names_current[idx], other_box_names_current[other_idx], box_current, t)
-           
-            #Box to agent following
-            for idx, box_current in enumerate(box_states_current):
-                if box_current == other_agent_state_previous:
-                    return AgentBoxFollowConflict(agent_j, agent_i, box_names_current[idx], box_current, t,1)
-
-    return None    
-
-# Used in CBS line 136 - > A = add_constraint(C, A, agent_i)
-
-def add_constraint(conflict, node, agent):
+    plans = {i: plan for i, plan in enumerate(plan_list) if plan is not None and len(plan) > 0}
+    if not plans:
+        return {}
+    length = max(len(plan) for plan in plans.values())
+
+    # (cell, t) -> plan indices, shorter plans wait at their last step
+    packed = {i: plan.cells(length) for i, plan in plans.items()}
+    cells = {i: steps.tolist() for i, steps in packed.items()}
+    occupancy = {}
+    for i, steps in cells.items():
+        for t, step in enumerate(steps):
+            for cell in step:
+                occupancy.setdefault((cell, t), []).append(i)
+
+    first = {}      # (i, j) -> earliest time step with a conflict
+    for i, steps in cells.items():
+        for t in range(1, length):
+            for cell in steps[t]:
+                for others in (occupancy.get((cell, t), ()), occupancy.get((cell, t - 1), ())):
+                    for j in others:
+                        if j == i or (i, j) in first:
+                            continue
+                        first[(i, j)] = t
+
+    return {(i, j): conflict_at(plans[i], plans[j], t, *step_matches(packed[i], packed[j], t)) for (i, j), t in first.items()}
+
+# Used in CBS - > constraint = get_constraint(C, agent_i)
+
+def get_constraint(conflict, agent):
+    ''' Returns the constraint that resolves the conflict for agent, or None if it cannot be resolved for it '''
 
     if isinstance(conflict, Conflict):
-        node.constraints.append(Constraint(agent, conflict.v, conflict.t))
+        return Constraint(agent, conflict.v, conflict.t)
 
     elif isinstance(conflict, mixedConflict): 
-        if node.agent == conflict.agents[0]:
-            node.constraints.append(Constraint(agent, conflict.v, conflict.t))                    
-        elif node.agent == conflict.agents[1]:
-            node.constraints.append(BoxConstraint(agent, conflict.box, conflict.v, conflict.t))  
+        if agent == conflict.agents[0]:
+            return Constraint(agent, conflict.v, conflict.t)
+        elif agent == conflict.agents[1]:
+            return BoxConstraint(agent, conflict.box, conflict.v, conflict.t)
 
     elif isinstance(conflict, BoxConflict):
-        if node.agent == conflict.agents[0]:
-            node.constraints.append(BoxConstraint(agent,conflict.box[0], conflict.loc_to, conflict.time))
-        elif node.agent == conflict.agents[1]:
-            node.constraints.append(BoxConstraint(agent,conflict.box[1], conflict.loc_to, conflict.time))
+        if agent == conflict.agents[0]:
+            return BoxConstraint(agent,conflict.box[0], conflict.loc_to, conflict.time)
+        elif agent == conflict.agents[1]:
+            return BoxConstraint(agent,conflict.box[1], conflict.loc_to, conflict.time)
 
     elif isinstance(conflict, AgentFollowConflict):
-        if node.agent == conflict.agents[0]:
-            node.constraints.append(Constraint(agent, conflict.v, conflict.t))
-        elif node.agent == conflict.agents[1]:
+        if agent == conflict.agents[0]:
+            return Constraint(agent, conflict.v, conflict.t)
+        elif agent == conflict.agents[1]:
             if conflict.t == 1:
                 return None
-            node.constraints.append(Constraint(agent, conflict.v, conflict.t-1))
+            return Constraint(agent, conflict.v, conflict.t-1)
 
     elif isinstance(conflict, AgentBoxFollowConflict):
-        if node.agent == conflict.agents[0]:
+        if agent == conflict.agents[0]:
             if conflict.follower == 0:
-                node.constraints.append(Constraint(agent, conflict.v, conflict.t))
+                return Constraint(agent, conflict.v, conflict.t)
             elif conflict.follower == 1:
                 if conflict.t == 1:
                     return None
-                node.constraints.append(Constraint(agent, conflict.v, conflict.t-1))
-        elif node.agent == conflict.agents[1]:
+                return Constraint(agent, conflict.v, conflict.t-1)
+        elif agent == conflict.agents[1]:
             if conflict.follower == 0:
                 if conflict.t == 1:
                     return None
-                node.constraints.append(BoxConstraint(agent,conflict.box, conflict.v, conflict.t-1))
+                return BoxConstraint(agent,conflict.box, conflict.v, conflict.t-1)
             elif conflict.follower == 1:
-                node.constraints.append(BoxConstraint(agent, conflict.box, conflict.v, conflict.t))
+                return BoxConstraint(agent, conflict.box, conflict.v, conflict.t)
 
     elif isinstance(conflict, BoxBoxFollowConflict):
-        if node.agent == conflict.agents[0]:
-            node.constraints.append(BoxConstraint(agent, conflict.box[0], conflict.v, conflict.t))
-        elif node.agent == conflict.agents[1]:
+        if agent == conflict.agents[0]:
+            return BoxConstraint(agent, conflict.box[0], conflict.v, conflict.t)
+        elif agent == conflict.agents[1]:
             if conflict.t == 1:
                 return None
-            node.constraints.append(BoxConstraint(agent, conflict.box[1], conflict.v, conflict.t-1))
+            return BoxConstraint(agent, conflict.box[1], conflict.v, conflict.t-1)
 
-    return node
\ No newline at end of file
+    return None
@@ -0,0 +1,119 @@
+''' Level-wide shortest path distances, shared by every agent and every replan '''
+
+import hashlib
+import os
+import sys
+import tempfile
+import numpy as np
+
+# Distance of the cells that cannot be reached (walls included)
+UNREACHABLE = 999
+
+# Directory of the on-disk cache of distance tables, set from the command line (empty to disable)
+cache_dir = os.path.join(tempfile.gettempdir(), 'searchclient-cache')
+
+class DistanceOracle:
+
+    def __init__(self, walls, goals = ()):
+        self.free = ~np.array(walls, dtype=bool)
+        self.shape = self.free.shape
+        self.grids = {}         # Source (row, col) -> distance grid, filled on demand
+        self.sources = sorted({pos for _, pos in goals})
+        self.table_path = None  # On-disk table of the grids of the sources, when there is one
+        if self.sources:
+            self.load_tables()
+
+    def get(self, source: '(int, int)') -> 'np.ndarray':
+        ''' Returns the grid of distances from source to every cell. The grid is shared, do not modify it. '''
+        grid = self.grids.get(source)
+        if grid is None:
+            grid = self.bfs(source)
+            self.grids[source] = grid
+        return grid
+
+    def bfs(self, source: '(int, int)') -> 'np.ndarray':
+        # Breadth-first search that expands the whole layer at once with shifted boolean masks
+        free = self.free
+        distances = np.full(self.shape, UNREACHABLE, dtype=np.int16)
+        layer = np.zeros(self.shape, dtype=bool)
+        layer[source] = True
+        visited = layer.copy()
+        depth = 0
+        while layer.any():
+            distances[layer] = depth
+            depth += 1
+            neighbors = np.zeros(self.shape, dtype=bool)
+            neighbors[1:, :] |= layer[:-1, :]
+            neighbors[:-1, :] |= layer[1:, :]
+            neighbors[:, 1:] |= layer[:, :-1]
+            neighbors[:, :-1] |= layer[:, 1:]
+            layer = neighbors & free & ~visited
+            visited |= layer
+        return distances
+
+    def fingerprint(self) -> 'str':
+        # Distances only depend on the walls and on which goal cells are sources
+        digest = hashlib.sha1()
+        digest.update(np.array(self.shape, dtype=np.int64).tobytes())
+        digest.update(np.packbits(self.free).tobytes())
+        digest.update(np.array(self.sources, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def load_tables(self):
+        '''
+        Fills the grids of every goal cell at once. The table is read from the on-disk cache as a
+        read-only memory map, so repeated runs (and concurrent processes) skip the BFS and share the pages.
+        On a miss it is computed and written for the next run.
+        '''
+        path = os.path.join(cache_dir, self.fingerprint() + '.npy') if cache_dir else None
+        table = None
+        if path and os.path.exists(path):
+            try:
+                table = np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                table = None
+        if table is None or table.shape != (len(self.sources),) + self.shape:
+            table = np.stack([self.bfs(source) for source in self.sources])
+            if path and not self.save_table(path, table):
+                path = None
+
+        self.table_path = path
+        for source, grid in zip(self.sources, table):
+            self.grids[source] = grid
+
+    def __getstate__(self):
+        '''
+        Pickling a memory map copies its content, so the pool workers would each get a private copy of the table.
+        The grids of the sources are left out when the table is on disk, only its path is sent.
+        '''
+        state = dict(self.__dict__)
+        if self.table_path:
+            state['grids'] = {source: grid for source, grid in self.grids.items() if source not in self.sources}
+        return state
+
+    def __setstate__(self, state):
+        # Map the table again read-only, the pages are shared with the other processes of the level
+        self.__dict__.update(state)
+        if self.table_path:
+            try:
+                table = np.load(self.table_path, mmap_mode='r')
+            except (OSError, ValueError):
+                table = None
+            if table is None or table.shape != (len(self.sources),) + self.shape:
+                self.load_tables()
+                return
+            for source, grid in zip(self.sources, table):
+                self.grids[source] = grid
+
+    def save_table(self, path: 'str', table: 'np.ndarray') -> 'bool':
+        # Write to a private file first, so a concurrent reader never maps a half-written table
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temporary_path, 'wb') as file:
+                np.save(file, table)
+            os.replace(temporary_path, path)
+            return True
+        except OSError as error:
+            print('#Could not write the distance cache:', error, file=sys.stderr, flush=True)
+            return False
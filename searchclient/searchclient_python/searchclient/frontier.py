@@ -1,36 +1,47 @@
 from heapq import heappush, heappop
+from novelty import NoveltyTable
 
 class FrontierBestFirstWidth():
-    
+
     def __init__(self, heuristic: 'Heuristic'):
         self.heuristic = heuristic
         self.queue = []
-        self.set = []
+        self.set = {}           # State -> live heap entry, gives O(1) membership and removal
         self.counter = 0
-        self.explored = []
-    
+        self.novelty = NoveltyTable()
+
     def add(self, state: 'State'):
-        self.heuristic.get_w(self.explored, state)     
+        self.heuristic.get_w(self.novelty, state)
         priority = (self.heuristic.f(state))
-        heappush(self.queue, (priority, self.counter, state))
+        if state.reservations.avoidance is not None:
+            priority = (priority, state.conflicts)    # Among equal priorities, fewer conflicts with the other paths first
+        entry = self.set.get(state)
+        if entry is not None:
+            if entry[0] <= priority:        # Already queued with a priority at least as good
+                return
+            entry[2] = None                 # Decrease-key: the old heap entry is lazily deleted
+        entry = [priority, self.counter, state]
+        heappush(self.queue, entry)
         self.counter += 1
-        self.set.append(state)
-    
+        self.set[state] = entry
+
     def pop(self) -> 'State':
-        if not self.queue:
-            return None
-        _, _, state = heappop(self.queue)
-        self.set.remove(state)
-        return state    
-    
+        # Skip the entries invalidated by a decrease-key
+        while self.queue:
+            _, _, state = heappop(self.queue)
+            if state is not None:
+                del self.set[state]
+                return state
+        return None
+
     def is_empty(self) -> 'bool':
-        return len(self.queue) == 0
-    
+        return len(self.set) == 0
+
     def size(self) -> 'int':
-        return len(self.queue)
-    
+        return len(self.set)
+
     def contains(self, state: 'State') -> 'bool':
         return state in self.set
-    
+
     def get_name(self):
-        return 'best-first width search with custom priority'.format(self.heuristic)
\ No newline at end of file
+        return 'best-first width search with custom priority'.format(self.heuristic)
@@ -11,16 +11,21 @@ def search(initial_state, frontier):
        
         iterations = 0
 
-        frontier.explored.append(initial_state.atoms)
+        # Expanded states, keyed by configuration and time clamped to the last constraint time
+        explored = set()
+
         frontier.add(initial_state)
 
+        # A goal only counts once every constraint of the search is behind
+        longest_time = initial_state.reservations.horizon
+
         while True:
             iterations += 1
             if iterations % 1000 == 0:
-                print_search_status(frontier.explored, frontier)
+                print_search_status(explored, frontier)
 
             if memory.get_usage() > memory.max_usage:
-                print_search_status(frontier.explored, frontier)
+                print_search_status(explored, frontier)
                 print('Maximum memory usage exceeded.', file=sys.stderr, flush=True)
                 return None
 
@@ -30,12 +35,6 @@ def search(initial_state, frontier):
             
             current_state = frontier.pop()
             current_time = current_state.g+1
-            current_constraints = current_state.constraints
-            constraint_times = [constraint.time for constraint in current_constraints]
-            longest_time = 0
-
-            if constraint_times:
-                longest_time = max(constraint_times)
 
             if current_state.is_goal_state() and current_time > longest_time:
                 plan, plan_repr = current_state.extract_plan()
@@ -43,11 +42,12 @@ def search(initial_state, frontier):
 
             expanded_states = current_state.get_expanded_states()
 
-            frontier.explored.append(current_state.atoms)
+            explored.add(current_state)
+            frontier.novelty.update(current_state.atoms)
 
             for child_state in expanded_states:
                 
-                if not frontier.contains(child_state) and child_state.constraint_step == False:
+                if child_state.constraint_step == False and child_state not in explored and not frontier.contains(child_state):
                     frontier.add(child_state)        
 
 def print_search_status(explored, frontier):
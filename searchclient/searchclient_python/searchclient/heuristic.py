@@ -1,143 +1,156 @@
 from abc import ABCMeta
-from collections import deque
+from collections import Counter
 import numpy as np
 import string   
 from utils import manhattan
 
 class Heuristic(metaclass=ABCMeta):
+
+    # Worker name -> (goal letters, atom costs, surplus, surplus costs), built by the first search of the worker
+    tables = {}
+
     def __init__(self, initial_state: 'State'):
         # Here's a chance to pre-process the static parts of the level.
-        self.goal_matrix = np.array(initial_state.goals)
-        self.wall_matrix = np.array(initial_state.walls).astype(int)
+        self.num_cols = initial_state.num_cols
         self.current_agent = None
         self.current_box = None
         self.alphabet = string.ascii_uppercase
         self.latest_state = initial_state
         self.novelty_sets = []                             # We assume PDDL tuples
 
-        def get_neighbors(grid, pos):
-            
-            neighbors = []
-            rows, cols = len(grid), len(grid[0])
-            x, y = pos
-            
-            # Define offsets for possible movements (up, down, left, right)
-            movements = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-            
-            for dx, dy in movements:
-                nx, ny = x + dx, y + dy
-                # Check if the neighboring position is within the grid boundaries
-                if 0 <= nx < rows and 0 <= ny < cols:
-                    # Check if the neighboring position is not a wall (assuming 0 represents free space)
-                    if grid[nx][ny] == 0:
-                        neighbors.append((nx, ny))
-
-            return neighbors
-
-        def get_path(grid, goal_pos):
-            # Initialize an array to store shortest path distances
-            distances = np.zeros_like(grid)           
-            # Backtrack
-            queue = deque([goal_pos])
-            while queue:
-                current_pos = queue.popleft()
-                for neighbor in get_neighbors(grid, current_pos):
-                    # Populate distances
-                    if distances[neighbor] == 0:
-                        distances[neighbor] = distances[current_pos] + 1
-                        queue.append(neighbor)
-
-            # Fill remaining cells (walls) with 999
-            distances[distances == 0] = 999
-
-            # And return goal position value to 0
-            distances[goal_pos] = 0
-            return distances
-        
+        # Every search of a worker starts from its initial state, so its tables are shared by all the replans
+        tables = Heuristic.tables.get(initial_state.worker_name)
+        if tables is None:
+            tables = Heuristic.build_tables(initial_state)
+            Heuristic.tables[initial_state.worker_name] = tables
+        self.goal_letters, self.atom_costs, self.surplus, self.surplus_costs = tables
+
+    @staticmethod
+    def build_tables(initial_state: 'State') -> 'tuple':
+        goal_matrix = np.array(initial_state.goals)
+        wall_matrix = np.array(initial_state.walls).astype(int)
+
         # Get location of each goal
 
         goal_positions = []
 
         # Agents
         for goal in range(10):
-            goal_pos = np.where(self.goal_matrix == str(goal))
+            goal_pos = np.where(goal_matrix == str(goal))
             if goal_pos[0].size > 0:
                 goal_pos = (int(goal_pos[0][0]), int(goal_pos[1][0]))
                 goal_positions.append((goal, goal_pos))
         # Boxes
-        for goal in self.alphabet:
-            goal_positions.extend([(goal, (x, y)) for x, y in zip(*np.where(self.goal_matrix == goal))])
+        for goal in string.ascii_uppercase:
+            goal_positions.extend([(goal, (int(x), int(y))) for x, y in zip(*np.where(goal_matrix == goal))])
 
-        # Get grids on a lookup table
+        # Get grids on a lookup table, the BFS runs once per goal cell for the whole level (see DistanceOracle)
 
-        self.grids = {}
+        grids = {}
+        distances = initial_state.distances
 
         for goal_name, goal_pos in goal_positions:
             if type(goal_name) == str:
                 unique_goal_id = f"{goal_name}_({goal_pos[0]}, {goal_pos[1]})"
-                self.grids[unique_goal_id] = get_path(self.wall_matrix, goal_pos)
+                grids[unique_goal_id] = distances.get(goal_pos)
             else:
-                self.grids[goal_name] = get_path(self.wall_matrix, goal_pos)
-    
+                grids[goal_name] = distances.get(goal_pos)
+
+        # Lookup table atom -> goal distance, with atoms the ids entity * num_cells + cell of State.get_atoms
+
+        num_rows, num_cols = wall_matrix.shape
+        num_cells = num_rows * num_cols
+        goal_counts = Counter(key[0] for key in grids.keys() if isinstance(key, str))
+        box_counts = Counter(box for _, box in initial_state.boxes)
+        goal_letters = set(goal_counts)
+        atom_costs = [0] * (36 * num_cells)
+        # Letters with more boxes than goals only count their nearest boxes, so they stay out of the incremental sum
+        surplus = {letter: goal_counts[letter] for letter in goal_counts if box_counts[letter] > goal_counts[letter]}
+        surplus_costs = {}
+
+        if goal_letters:
+            # Boxes are charged the distance to the nearest goal of their letter, the agent the distance to its own goal
+            for letter in goal_letters:
+                nearest = np.min([grid for key, grid in grids.items() if isinstance(key, str) and key[0] == letter], axis=0)
+                if letter in surplus:
+                    surplus_costs[letter] = nearest.ravel().tolist()
+                    continue
+                entity = ord(letter) - ord('A') + 10
+                atom_costs[entity * num_cells:(entity + 1) * num_cells] = nearest.ravel().tolist()
+            agent_num = initial_state.worker_name
+            if agent_num in grids:
+                atom_costs[agent_num * num_cells:(agent_num + 1) * num_cells] = grids[agent_num].ravel().tolist()
+        else:
+            # Pathfinding, the agent heads to its goal or to the cell (n, n) when it has none
+            agent_num = initial_state.worker_name
+            if agent_num in grids:
+                costs = grids[agent_num].ravel().tolist()
+            else:
+                costs = [manhattan(divmod(cell, num_cols), (agent_num, agent_num)) for cell in range(num_cells)]
+            atom_costs[agent_num * num_cells:(agent_num + 1) * num_cells] = costs
+
+        return goal_letters, atom_costs, surplus, surplus_costs
 
     def h(self, state: 'State') -> 'int':
-        
-        count0 = 0
-        count1 = 0
-        count = 0
 
-        ''' SAboxes '''           
-
-        # Default to boxes
-        if any(isinstance(key, str) for key in self.grids.keys()):
-            boxes = []
-            grids = []
-            for x, row in enumerate(state.boxes):
-                for y, box in enumerate(row):
-                    # Filters empty tiles and unassigned boxes
-                    if box != '' and any(key.startswith(box) for key in self.grids.keys()):
-                        box_pos = (x, y)
-                        boxes.append((box, box_pos))
-            boxes = sorted(boxes, key=lambda box: box[0])
-            for key, grid in self.grids.items():
-                grids.append(grid)  
-            # Loop through boxes and grids, alphabetically. Assigns each box to its grid, so it works also when they are not specifically labeled
-            for box, grid in zip(boxes, grids):
-                grid = np.array(grid)
-                ''' If we want to add nearest box heuristic in the mix '''
-                count0 += grid[box[1][0]][box[1][1]]
-                count1 += manhattan((box[1][0], box[1][1]), (state.agent_rows[0], state.agent_cols[0]))
-
-            return (count0, count1)
+        ''' Goal distance of the atoms, derived from the parent's value and the atoms moved by the action '''
+
+        costs = self.atom_costs
+        if state.h is None:
+            parent = state.parent
+            if parent is not None and parent.h is not None:
+                removed, added = state.get_moved_atoms()
+                state.h = parent.h
+                for atom in removed:
+                    state.h -= costs[atom]
+                for atom in added:
+                    state.h += costs[atom]
+                if self.surplus and state.boxes is not parent.boxes:
+                    state.h += self.get_surplus_h(state) - self.get_surplus_h(parent)
+            else:
+                state.h = sum(costs[atom] for atom in state.atoms) + self.get_surplus_h(state)
+
+        ''' SAboxes '''
+
+        # Default to boxes, with the distance of the agent to the boxes with a goal as tie-breaker
+        if self.goal_letters:
+            count1 = 0
+            agent_pos = divmod(state.agents[0], self.num_cols)
+            for cell in self.get_counted_boxes(state):
+                count1 += manhattan(divmod(cell, self.num_cols), agent_pos)
+
+            return (state.h, count1)
 
         # Default to pathfinding
         else:
-            agents = []
-            for agent_row in state.agent_rows:
-                agent_num = state.worker_name
-                agent_col = state.agent_cols[0]
-                agent_pos = (agent_row, agent_col)
-                if agent_num in self.grids:
-                    grid = self.grids[agent_num]
-                    count += grid[agent_pos]
-                    # agents.append(grid[agent_pos])
-                    # count = max(agents)
-                else: 
-                    count += manhattan(agent_pos, (agent_num, agent_num))
+            return int(state.h)
 
-            return int(count)
+    def get_surplus_h(self, state: 'State') -> 'int':
+        # Sum over the letters with spare boxes of the distances of the boxes nearest to a goal, one per goal
+        count = 0
+        for letter, goal_count in self.surplus.items():
+            letter_costs = self.surplus_costs[letter]
+            count += sum(sorted(letter_costs[cell] for cell, box in state.boxes if box == letter)[:goal_count])
+        return count
 
-    def get_w(self, explored, state: 'State') -> 'int':
+    def get_counted_boxes(self, state: 'State') -> '[int, ...]':
+        # Cells of the boxes that take part in h
+        cells = [cell for cell, box in state.boxes if box in self.goal_letters and box not in self.surplus]
+        for letter, goal_count in self.surplus.items():
+            letter_costs = self.surplus_costs[letter]
+            cells.extend(sorted((cell for cell, box in state.boxes if box == letter), key=lambda cell: letter_costs[cell])[:goal_count])
+        return cells
 
-        state_repr = state.atoms
+    def goal_count(self, state: 'State') -> 'int':
+        # Unsatisfied goals, maintained incrementally by State.result
+        return state.unsatisfied
 
-        if state_repr not in explored:        # If one atom is novel
-            state.w = 0
+    def get_w(self, novelty, state: 'State') -> 'int':
 
-        else:
-            state.w = explored.count(state_repr)
+        # Width of the state w.r.t. the atoms of the expanded states (1 if one atom is novel)
+        state.w = novelty.get_novelty(state.atoms)
 
-        return
+        return state.w
 
 # Mixed BFWS
 
@@ -150,7 +163,7 @@ class HeuristicBFWS(Heuristic):
         if type(heuristic_value) == int:        # MAPF, we can be greedy
             return (heuristic_value)
         else:
-            return ((state.w + heuristic_value[0], heuristic_value[1]))     # Boxes, incomplete, we have to add width/g to avoid loops
+            return ((state.w + heuristic_value[0], self.goal_count(state), heuristic_value[1]))     # Boxes, incomplete, we have to add width/g to avoid loops
     
     def __repr__(self):
         return 'BFWS evaluation'
\ No newline at end of file
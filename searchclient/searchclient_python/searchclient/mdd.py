@@ -0,0 +1,46 @@
+''' Multi-valued decision diagrams of the agent-only workers, used by CBS to classify conflicts '''
+
+from state import State
+from conflictmodule import Constraint
+
+class MDD:
+    '''
+    Cells the agent of a worker can occupy at every time step on some path of a given cost that
+    reaches its goal and respects its constraints. Level t is the set of those cells at time t.
+    '''
+    def __init__(self, state: 'State', constraints: 'list', cost: 'int'):
+        blocked = {}            # time -> cells the agent may not occupy
+        for constraint in constraints:
+            if isinstance(constraint, Constraint):
+                cell = constraint.loc_to[0] * State.num_cols + constraint.loc_to[1]
+                blocked.setdefault(constraint.time, set()).add(cell)
+
+        goals = [cell for cell, goal in State.goal_index[state.worker_name].items() if '0' <= goal <= '9']
+
+        # Forward from the start, a move or a wait at every step
+        forward = [{state.agents[0]}]
+        for t in range(1, cost + 1):
+            cells = set()
+            for cell in forward[-1]:
+                cells.update(MDD.successors(cell))
+            forward.append(cells - blocked.get(t, set()))
+
+        # Backward from the goal (anywhere without one), keeping the cells on both sides
+        self.levels = [None for _ in range(cost + 1)]
+        self.levels[cost] = forward[cost] & set(goals) if goals else forward[cost]
+        for t in range(cost - 1, -1, -1):
+            cells = set()
+            for cell in forward[t]:
+                if not self.levels[t + 1].isdisjoint(MDD.successors(cell)):
+                    cells.add(cell)
+            self.levels[t] = cells
+
+    @staticmethod
+    def successors(cell: 'int') -> '[int, ...]':
+        # Waiting and the moves the walls allow, from the action table
+        return [cell] + [free for _, box_cell, free in State.action_table[cell] if box_cell is None and free is not None]
+
+    def is_singleton(self, cell: '(int, int)', time: 'int') -> 'bool':
+        ''' True if every path of this cost is at cell at time, a constraint there raises the cost '''
+        level = self.levels[min(time, len(self.levels) - 1)]     # The agent waits at the end of its path
+        return len(level) == 1 and cell[0] * State.num_cols + cell[1] in level
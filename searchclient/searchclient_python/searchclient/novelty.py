@@ -0,0 +1,43 @@
+''' Novelty tables for the width computation of BFWS '''
+
+from collections import Counter
+
+# Width bound of the novelty tables, set from the command line
+max_width = 2
+
+class NoveltyTable:
+
+    def __init__(self, width: 'int' = None):
+        self.width = max_width if width is None else width
+        self.atoms = set()          # w = 1 table: ids of the atoms seen in an expanded state
+        self.pairs = set()          # w = 2 table: packed id pairs seen in an expanded state
+        self.counts = Counter()     # Expansions of each full atom set, penalizes states that are not novel at all
+
+    def get_novelty(self, atoms) -> 'int':
+        """
+        Returns the size of the smallest tuple of atoms that no expanded state has made true.
+        If every tuple up to the width bound has already been seen, returns width + 1 plus
+        the number of times the same atom set has been expanded, so revisits keep losing priority.
+        """
+        ids = sorted(atoms)         # Atoms are already interned integer ids (see State.get_atoms)
+        seen = self.atoms
+        for atom in ids:
+            if atom not in seen:
+                return 1
+
+        if self.width >= 2:
+            seen = self.pairs
+            for i, atom in enumerate(ids):
+                for other in ids[i + 1:]:
+                    if atom << 32 | other not in seen:
+                        return 2
+
+        return self.width + 1 + self.counts[atoms]
+
+    def update(self, atoms):
+        # Called once per expansion, every lookup above is a hash probe whatever the size of the search
+        ids = sorted(atoms)
+        self.counts[atoms] += 1
+        self.atoms.update(ids)
+        if self.width >= 2:
+            self.pairs.update(atom << 32 | other for i, atom in enumerate(ids) for other in ids[i + 1:])
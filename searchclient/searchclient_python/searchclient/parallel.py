@@ -0,0 +1,36 @@
+''' Process pool for the low-level searches of CBS '''
+
+from concurrent.futures import ProcessPoolExecutor
+import psutil
+import memory
+import novelty
+import distance
+import sipp
+from state import State
+
+# Number of worker processes, set from the command line (1 keeps every search in the main process)
+workers = 1
+
+_pool = None
+
+def get_pool() -> 'ProcessPoolExecutor':
+    '''
+    Returns the shared pool, or None when running sequentially. The pool is started on first use,
+    after the level is parsed, and every worker receives the static level data once at start-up.
+    '''
+    global _pool
+    if _pool is None and workers > 1:
+        settings = (memory.max_usage, novelty.max_width, distance.cache_dir, sipp.enabled)
+        _pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(State.get_level(), settings))
+    return _pool
+
+def init_worker(level: 'dict', settings: 'tuple'):
+    State.load_level(level)
+    memory.max_usage, novelty.max_width, distance.cache_dir, sipp.enabled = settings
+    memory._process = psutil.Process()     # A forked worker would otherwise measure its parent
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
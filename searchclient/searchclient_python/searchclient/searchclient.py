@@ -2,8 +2,13 @@ import argparse
 import sys
 import time
 import memory
+import novelty
+import distance
+import parallel
+import sipp
 from color import Color
 from state import State
+import cbs
 from cbs import CBS
 from utils import Worker
 
@@ -106,6 +111,9 @@ class SearchClient:
                         goals_to_assign.add((c, (row, col)))  
                     elif c.isdigit():
                         goals_to_assign.add((c, (row, col)))     
+
+        # Keep every goal of the level, the distance tables are computed (or loaded) for all of them at once
+        level_goals = sorted(goals_to_assign)
             
         # Now we assign goals and boxes for each worker
         # Part 1: assign goals and box per goal
@@ -148,9 +156,7 @@ class SearchClient:
                 workers[current_worker_index] = chosen_worker
                 break
 
-        State.agent_colors = agent_colors
-        State.walls = walls
-        State.box_colors = box_colors
+        State.set_level(walls, agent_colors, box_colors, level_goals)
             
         ''' We finished the state building for a single worker '''
 
@@ -188,6 +194,7 @@ class SearchClient:
         initial_states = SearchClient.parse_filtered_levels(server_messages)
 
         joint_plan, is_single = CBS(initial_states)
+        parallel.shutdown()
 
         # Print plan to server.
         if joint_plan is None:
@@ -209,6 +216,15 @@ if __name__ == '__main__':
     # Program arguments.
     parser = argparse.ArgumentParser(description='Simple client based on state-space graph search.')
     parser.add_argument('--max-memory', metavar='<MB>', type=float, default=2048.0, help='The maximum memory usage allowed in MB (soft limit, default 2048).')
+    parser.add_argument('--width', metavar='<W>', type=int, choices=[1, 2], default=2, help='The width bound of the BFWS novelty tables (default 2).')
+    parser.add_argument('--workers', metavar='<N>', type=int, default=1, help='Number of processes running the low-level searches of CBS (default 1, no pool).')
+    parser.add_argument('--cat', action='store_true', help='Break low-level ties with a conflict avoidance table of the other agents\' paths.')
+    parser.add_argument('--icbs', action='store_true', help='Split on cardinal conflicts first (MDDs of the agent-only workers) and bypass same-cost children.')
+    parser.add_argument('--cbsh', action='store_true', help='Add a minimum vertex cover of the cardinal conflicts to the cost of the constraint tree nodes.')
+    parser.add_argument('--repair', action='store_true', help='Replan the children of CBS from their parent\'s path shortly before the new constraint, from the start if that fails.')
+    parser.add_argument('--low-level', choices=['bfws', 'sipp'], default='bfws', help='Low-level search of CBS for the workers without boxes: BFWS or safe interval path planning (default bfws).')
+    parser.add_argument('--plan-cache', metavar='<N>', type=int, default=cbs.plan_cache_size, help='Entries of the LRU cache of CBS low-level plans, 0 to disable (default {}).'.format(cbs.plan_cache_size))
+    parser.add_argument('--cache-dir', metavar='<DIR>', type=str, default=distance.cache_dir, help='Directory of the on-disk cache of level distance tables, empty to disable (default {}).'.format(distance.cache_dir))
     
     strategy_group = parser.add_mutually_exclusive_group()
     strategy_group.add_argument('-cbs', action='store_true', dest='cbs', help='Use the CBS strategy.')
@@ -217,6 +233,23 @@ if __name__ == '__main__':
     
     # Set max memory usage allowed (soft limit).
     memory.max_usage = args.max_memory
+
+    # Set the width bound of the novelty tables.
+    novelty.max_width = args.width
+
+    # Set the cache of precomputed level tables.
+    distance.cache_dir = args.cache_dir
+
+    # Set the size of the low-level search pool.
+    parallel.workers = args.workers
+
+    # Set the low-level tie-breaking of CBS.
+    cbs.conflict_avoidance = args.cat
+    cbs.cardinal_conflicts = args.icbs
+    cbs.cardinal_heuristic = args.cbsh
+    cbs.plan_repair = args.repair
+    cbs.plan_cache_size = args.plan_cache
+    sipp.enabled = args.low_level == 'sipp'
     
     # Run client.
     SearchClient.main(args)
\ No newline at end of file
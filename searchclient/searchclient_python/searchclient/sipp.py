@@ -0,0 +1,119 @@
+''' Safe interval path planning, the low level of CBS for the agent-only workers '''
+
+from heapq import heappush, heappop
+import numpy as np
+from action import Action
+from state import State
+from conflictmodule import Constraint
+from trajectory import Trajectory
+
+# Plan the agent-only workers with SIPP instead of BFWS, set from the command line
+enabled = False
+
+INFINITY = float('inf')
+
+def safe_intervals(constraints) -> 'dict':
+    '''
+    Cell -> sorted list of (start, end) time intervals in which the agent may stand on the cell.
+    Cells without a constraint are missing, they are safe from time 0 on.
+    '''
+    blocked = {}
+    for constraint in constraints:
+        if isinstance(constraint, Constraint):
+            cell = constraint.loc_to[0] * State.num_cols + constraint.loc_to[1]
+            blocked.setdefault(cell, set()).add(constraint.time)
+
+    intervals = {}
+    for cell, times in blocked.items():
+        cell_intervals = []
+        start = 0
+        for time in sorted(times):
+            if time > start:
+                cell_intervals.append((start, time - 1))
+            start = time + 1
+        cell_intervals.append((start, INFINITY))
+        intervals[cell] = cell_intervals
+    return intervals
+
+def plan(state: 'State', constraints) -> '([Action, ...], Trajectory)':
+    '''
+    A* over (cell, safe interval) pairs from the agent of state to its goal, at the earliest arrival time in
+    every interval. Waiting is folded into the moves, so the search does not grow with the constraint times.
+    The goal counts in the last interval of the goal cell, where the agent can stay forever.
+    Returns (plan, trajectory) like graphsearch.search, (None, None) if there is no plan.
+    '''
+    intervals = safe_intervals(constraints)
+    always = [(0, INFINITY)]
+    start = state.agents[0]
+    goals = [cell for cell, goal in State.goal_index[state.worker_name].items() if '0' <= goal <= '9']
+    num_cols = State.num_cols
+    if goals:
+        grid = State.distances.get(divmod(goals[0], num_cols))
+        heuristic = lambda cell: int(grid[divmod(cell, num_cols)])
+        is_goal = lambda cell: cell == goals[0]
+    else:
+        heuristic = lambda cell: 0
+        is_goal = lambda cell: True
+
+    start_intervals = intervals.get(start, always)
+    if start_intervals[0][0] > 0:
+        return None, None
+
+    # Open list of (f, -time, counter, cell, interval index), ties go to the deeper node
+    open_list = [(heuristic(start), 0, 0, start, 0)]
+    counter = 1
+    arrival = {(start, 0): 0}
+    parents = {(start, 0): None}        # (cell, interval) -> (parent key, action)
+    closed = set()
+
+    while open_list:
+        _, time, _, cell, index = heappop(open_list)
+        time = -time
+        key = (cell, index)
+        if key in closed:
+            continue
+        closed.add(key)
+
+        cell_intervals = intervals.get(cell, always)
+        end = cell_intervals[index][1]
+        if is_goal(cell) and end == INFINITY:
+            return extract_plan(state, key, arrival, parents)
+
+        for action, box_cell, destination in State.action_table[cell]:
+            if box_cell is not None or destination is None:
+                continue
+            for next_index, (next_start, next_end) in enumerate(intervals.get(destination, always)):
+                # Leave as early as the destination interval allows, staying in the current interval until then
+                next_time = max(time + 1, next_start)
+                if next_time > next_end or next_time - 1 > end:
+                    continue
+                next_key = (destination, next_index)
+                if next_key in closed or next_time >= arrival.get(next_key, INFINITY):
+                    continue
+                arrival[next_key] = next_time
+                parents[next_key] = (key, action)
+                heappush(open_list, (next_time + heuristic(destination), -next_time, counter, destination, next_index))
+                counter += 1
+
+    return None, None
+
+def extract_plan(state: 'State', key, arrival, parents) -> '([Action, ...], Trajectory)':
+    # Walk back the moves, padding the waits before each move with NoOps
+    steps = []
+    while parents[key] is not None:
+        parent_key, action = parents[key]
+        waits = arrival[key] - arrival[parent_key] - 1
+        steps.append((action, key[0], parent_key[0], waits))
+        key = parent_key
+
+    plan = []
+    cells = [state.agents[0]]
+    for action, cell, parent_cell, waits in reversed(steps):
+        plan.extend([[Action.NoOp]] * waits)
+        cells.extend([parent_cell] * waits)
+        plan.append([action])
+        cells.append(cell)
+
+    rows, cols = np.divmod(np.array(cells, dtype=np.int64), State.num_cols)
+    positions = np.stack((rows, cols), axis=-1).reshape(len(cells), 1, 2).astype(np.int16)
+    return plan, Trajectory(np.array([int(state.worker_name)], dtype=np.int16), positions)
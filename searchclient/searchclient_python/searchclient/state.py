@@ -1,113 +1,344 @@
 import random
+from bisect import insort
+import numpy as np
 
 from action import Action, ActionType
-from conflictmodule import Constraint, BoxConstraint
+from distance import DistanceOracle
+from conflictmodule import ReservationTable
+from trajectory import Trajectory
 
 class State:
     _RNG = random.Random(1)
-    
+
+    # Static level data, shared by every state (see set_level)
+    walls = None
+    wall_cells = None
+    num_rows = 0
+    num_cols = 0
+    num_cells = 0
+    agent_colors = None
+    box_colors = None
+    worker_goals = {}
+    goal_index = {}         # Worker name -> {cell: goal character}
+    distances = None
+    action_table = None
+
+    # Zobrist keys, one random bitstring per (entity, cell) and per clamped time step
+    agent_keys = None
+    box_keys = None
+    time_keys = [0]
+
+    # Everything set_level and the initial states store on the class, shipped once to pool workers
+    level_attributes = ('walls', 'wall_cells', 'num_rows', 'num_cols', 'num_cells', 'agent_colors', 'box_colors',
+                        'worker_goals', 'goal_index', 'distances', 'action_table', 'agent_keys', 'box_keys', 'time_keys')
+
+    # Cells are flat indices row * num_cols + col, boxes a sorted tuple of (cell, letter)
+    __slots__ = ('worker_name', 'agents', 'boxes', 'parent', 'joint_action', 'g', 'time', '_hash',
+                 'constraint_step', 'reservations', 'w', 'h', 'unsatisfied', 'conflicts', '_atoms')
+
     def __init__(self, agent_rows, agent_cols, boxes, goals, worker_name, constraints = None):
-        
+
         self.worker_name = int(worker_name)
-        self.agent_rows = agent_rows
-        self.agent_cols = agent_cols
-        self.boxes = boxes
+        self.agents = tuple(row * State.num_cols + col for row, col in zip(agent_rows, agent_cols))
+        self.boxes = tuple((row * State.num_cols + col, box) for row, line in enumerate(boxes) for col, box in enumerate(line) if box)
         self.parent = None
         self.joint_action = None
         self.g = 0
-        self._hash = None
+        self.time = 0       # g clamped to the last constraint time, states past it are interchangeable
         self.constraint_step = False
-        self.constraints = constraints if constraints else []
-        self.goals = goals
+        self.set_constraints(constraints if constraints else [])
+        self.conflicts = 0  # Conflicts with the paths of the conflict avoidance table along the path to this state
         self.w = 1
-        def atoms(self):
-            """
-            Generates a set of atoms that represent the current state.
-
-            Args:
-            - state (State): The current state of the environment.
-
-            Returns:
-            - Set[Tuple[str, Tuple[int, int]]]: A set of tuples representing the state atoms.
-            """
-            atoms = set()
-            for index, row, col in zip(str(self.worker_name), self.agent_rows, self.agent_cols):
-                atoms.add((f'AgentAt{index}', (row, col)))
-
-            for (row_index, row) in enumerate(self.boxes):
-                for col_index, box in enumerate(row):
-                    if box:  
-                        atoms.add((f'BoxAt{box}', (row_index, col_index)))
-
-            return frozenset(atoms)     # Need the frozenset so I can add the state representation to the novelty set
-        self.atoms = atoms(self)
-    
+        self.h = None       # Goal distance, filled in by the heuristic
+        self._hash = 0
+        for agent, cell in enumerate(self.agents):
+            self._hash ^= State.agent_keys[agent][cell]
+        for cell, box in self.boxes:
+            self._hash ^= State.box_keys[box][cell]
+        self._atoms = None
+        # Goals are static, the state only keeps its worker name to find them
+        State.worker_goals[self.worker_name] = goals
+        State.goal_index[self.worker_name] = {row * State.num_cols + col: goal for row, line in enumerate(goals) for col, goal in enumerate(line) if goal}
+        self.unsatisfied = self.count_unsatisfied()
+
+    @staticmethod
+    def set_level(walls, agent_colors, box_colors, goals = ()):
+        ''' Stores the static level data, must be called before building the initial states '''
+        State.walls = walls
+        State.wall_cells = [wall for row in walls for wall in row]
+        State.num_rows = len(walls)
+        State.num_cols = len(walls[0])
+        State.num_cells = State.num_rows * State.num_cols
+        State.agent_colors = agent_colors
+        State.box_colors = box_colors
+        State.distances = DistanceOracle(walls, goals)
+
+        num_cells = State.num_cells
+        rng = random.Random(0)
+        State.agent_keys = [[rng.getrandbits(64) for _ in range(num_cells)] for _ in range(10)]
+        State.box_keys = {chr(ord('A') + box): [rng.getrandbits(64) for _ in range(num_cells)] for box in range(26)}
+        State.time_keys = [0]   # Unconstrained searches never leave time 0
+
+        State.action_table = [State.get_cell_actions(cell) for cell in range(num_cells)]
+
+    @staticmethod
+    def get_level() -> 'dict':
+        return {name: getattr(State, name) for name in State.level_attributes}
+
+    @staticmethod
+    def load_level(level: 'dict'):
+        # Restores the static data of get_level in another process
+        for name, value in level.items():
+            setattr(State, name, value)
+
+    @staticmethod
+    def get_cell_actions(cell: 'int') -> '[(Action, int, int), ...]':
+        '''
+        Actions that the walls allow from cell, as (action, box_cell, free_cell): the action applies
+        when box_cell (if any) holds a box and free_cell (if any) holds neither a box nor an agent.
+        '''
+        def neighbor(cell, row_delta, col_delta):
+            row, col = divmod(cell, State.num_cols)
+            row, col = row + row_delta, col + col_delta
+            if not (0 <= row < State.num_rows and 0 <= col < State.num_cols) or State.walls[row][col]:
+                return None
+            return row * State.num_cols + col
+
+        if State.wall_cells[cell]:
+            return []
+
+        actions = []
+        for action in Action:
+            if action.type is ActionType.NoOp:
+                actions.append((action, None, None))
+                continue
+
+            destination = neighbor(cell, action.agent_row_delta, action.agent_col_delta)
+            if destination is None:
+                continue
+
+            if action.type is ActionType.Move:
+                actions.append((action, None, destination))
+
+            elif action.type is ActionType.Push:
+                box_destination = neighbor(destination, action.box_row_delta, action.box_col_delta)
+                if box_destination is not None and box_destination != cell:
+                    actions.append((action, destination, box_destination))
+
+            elif action.type is ActionType.Pull:
+                box_cell = neighbor(cell, -action.box_row_delta, -action.box_col_delta)
+                if box_cell is not None and box_cell != destination:
+                    actions.append((action, box_cell, destination))
+
+        return actions
+
+    @staticmethod
+    def extend_time_keys(time):
+        rng = random.Random(len(State.time_keys))
+        while len(State.time_keys) <= time:
+            State.time_keys.append(rng.getrandbits(64))
+
+    def set_constraints(self, constraints, avoid = ()):
+        '''
+        Compiles the constraints of the search started from this state, children share the table.
+        The paths in avoid are not constraints, they only fill the conflict avoidance table.
+        '''
+        self.reservations = ReservationTable(constraints, State.num_cols, avoid)
+
+    @property
+    def goals(self):
+        return State.worker_goals[self.worker_name]
+
+    @property
+    def atoms(self) -> 'frozenset':
+        # Computed on first access, most generated states are discarded before anyone looks at them
+        if self._atoms is None:
+            parent = self.parent
+            if parent is not None and parent._atoms is not None:
+                removed, added = self.get_moved_atoms()
+                self._atoms = parent._atoms.difference(removed).union(added)
+            else:
+                self._atoms = self.get_atoms()
+        return self._atoms
+
+    def get_atoms(self) -> 'frozenset':
+        """
+        Generates a set of atoms that represent the current state.
+        An atom is the interned id entity * num_cells + cell, where entities 0-9 are agents
+        and entities 10-35 are the box letters A-Z (see atom_repr).
+
+        Returns:
+        - FrozenSet[int]: The ids of the state atoms.
+        """
+        num_cells = State.num_cells
+        atoms = set()
+        for index, cell in zip(str(self.worker_name), self.agents):
+            atoms.add(int(index) * num_cells + cell)
+
+        for cell, box in self.boxes:
+            atoms.add((ord(box) - ord('A') + 10) * num_cells + cell)
+
+        return frozenset(atoms)     # Need the frozenset so I can add the state representation to the novelty set
+
+    def get_moved_atoms(self) -> '([int, ...], [int, ...])':
+        # Atoms removed and added by the joint action that generated this state from its parent
+        num_cells = State.num_cells
+        num_cols = State.num_cols
+        removed = []
+        added = []
+        for (index, cell), parent_cell in zip(zip(str(self.worker_name), self.agents), self.parent.agents):
+            if cell != parent_cell:
+                removed.append(int(index) * num_cells + parent_cell)
+                added.append(int(index) * num_cells + cell)
+
+        for agent, action in enumerate(self.joint_action):
+            if action.type is ActionType.Push:
+                box_cell = self.agents[agent]
+                box_destination = box_cell + action.box_row_delta * num_cols + action.box_col_delta
+            elif action.type is ActionType.Pull:
+                box_destination = self.parent.agents[agent]
+                box_cell = box_destination - action.box_row_delta * num_cols - action.box_col_delta
+            else:
+                continue
+            entity = ord(self.box_at(box_destination)) - ord('A') + 10
+            removed.append(entity * num_cells + box_cell)
+            added.append(entity * num_cells + box_destination)
+
+        return removed, added
+
+    @staticmethod
+    def atom_repr(atom: 'int') -> '(str, (int, int))':
+        entity, cell = divmod(atom, State.num_cells)
+        if entity < 10:
+            return (f'AgentAt{entity}', divmod(cell, State.num_cols))
+        return (f'BoxAt{chr(entity - 10 + ord("A"))}', divmod(cell, State.num_cols))
+
     def result(self, joint_action: '[Action, ...]') -> 'State':
 
         '''
         Returns the state resulting from applying joint_action in this state.
         Precondition: Joint action must be applicable and non-conflicting in this state.
         '''
-        
-        # Copy this state.
-        copy_agent_rows = self.agent_rows[:]
-        copy_agent_cols = self.agent_cols[:]
-        copy_worker_name = self.worker_name
-        copy_boxes = [row[:] for row in self.boxes]
+
+        num_cols = State.num_cols
+        agent_keys = State.agent_keys
+        box_keys = State.box_keys
+        copy_agents = list(self.agents)
+        copy_boxes = self.boxes         # Only replaced when a box moves
+        copy_hash = self._hash          # Updated by XOR-ing out the old and in the new cell of what moves
+        goal_index = State.goal_index[self.worker_name]
+        unsatisfied = self.unsatisfied  # Updated when a box or the agent enters or leaves one of its goals
 
         # Apply each action.
-        for agent, action in enumerate(joint_action):  
+        for agent, action in enumerate(joint_action):
             if action.type is ActionType.NoOp:
                 pass
-            
+
             elif action.type is ActionType.Move:
-                copy_agent_rows[agent] += action.agent_row_delta
-                copy_agent_cols[agent] += action.agent_col_delta
+                copy_hash ^= agent_keys[agent][copy_agents[agent]]
+                copy_agents[agent] += action.agent_row_delta * num_cols + action.agent_col_delta
+                copy_hash ^= agent_keys[agent][copy_agents[agent]]
 
             elif action.type is ActionType.Push:
-                copy_agent_rows[agent] += action.agent_row_delta
-                copy_agent_cols[agent] += action.agent_col_delta
-                copy_boxes[copy_agent_rows[agent] + action.box_row_delta][copy_agent_cols[agent] + action.box_col_delta] = copy_boxes[copy_agent_rows[agent]][copy_agent_cols[agent]]
-                copy_boxes[copy_agent_rows[agent]][copy_agent_cols[agent]] = ''
+                copy_hash ^= agent_keys[agent][copy_agents[agent]]
+                copy_agents[agent] += action.agent_row_delta * num_cols + action.agent_col_delta
+                copy_hash ^= agent_keys[agent][copy_agents[agent]]
+                box_cell = copy_agents[agent]
+                box_destination = box_cell + action.box_row_delta * num_cols + action.box_col_delta
+                copy_boxes, box = State.move_box(copy_boxes, box_cell, box_destination)
+                copy_hash ^= box_keys[box][box_cell] ^ box_keys[box][box_destination]
+                if goal_index.get(box_cell) == box:
+                    unsatisfied += 1
+                if goal_index.get(box_destination) == box:
+                    unsatisfied -= 1
 
             elif action.type is ActionType.Pull:
-                copy_boxes[copy_agent_rows[agent]][copy_agent_cols[agent]] = copy_boxes[copy_agent_rows[agent] - action.box_row_delta][copy_agent_cols[agent] - action.box_col_delta]
-                copy_boxes[copy_agent_rows[agent] - action.box_row_delta][copy_agent_cols[agent] - action.box_col_delta] = ''
-                copy_agent_rows[agent] += action.agent_row_delta
-                copy_agent_cols[agent] += action.agent_col_delta
+                box_cell = copy_agents[agent] - action.box_row_delta * num_cols - action.box_col_delta
+                box_destination = copy_agents[agent]
+                copy_boxes, box = State.move_box(copy_boxes, box_cell, box_destination)
+                copy_hash ^= box_keys[box][box_cell] ^ box_keys[box][box_destination]
+                if goal_index.get(box_cell) == box:
+                    unsatisfied += 1
+                if goal_index.get(box_destination) == box:
+                    unsatisfied -= 1
+                copy_hash ^= agent_keys[agent][copy_agents[agent]]
+                copy_agents[agent] += action.agent_row_delta * num_cols + action.agent_col_delta
+                copy_hash ^= agent_keys[agent][copy_agents[agent]]
+
+        if copy_agents[0] != self.agents[0]:
+            if '0' <= goal_index.get(self.agents[0], '') <= '9':
+                unsatisfied += 1
+            if '0' <= goal_index.get(copy_agents[0], '') <= '9':
+                unsatisfied -= 1
 
-        copy_state = State(copy_agent_rows, copy_agent_cols, copy_boxes, self.goals, copy_worker_name, self.constraints)
+        copy_state = object.__new__(State)
+        copy_state.worker_name = self.worker_name
+        copy_state.agents = tuple(copy_agents)
+        copy_state.boxes = copy_boxes
         copy_state.parent = self
         copy_state.joint_action = joint_action[:]
         copy_state.g = self.g + 1
-        copy_state.constraints = self.constraints[:]
+        copy_state.reservations = self.reservations   # Shared, constraints do not change during a search
         copy_state.constraint_step = False
-        
-        for constraint in copy_state.constraints:
-            if isinstance(constraint, Constraint):
-                if (constraint.time == copy_state.g and (copy_agent_rows[0], copy_agent_cols[0]) == constraint.loc_to):
-                    copy_state.constraint_step = True
-            elif isinstance(constraint, BoxConstraint) and constraint.time == copy_state.g and copy_boxes[constraint.loc_to[0]][constraint.loc_to[1]] != '':
-                copy_state.constraint_step = True
+        copy_state.w = 1
+        copy_state.h = None
+        copy_state.unsatisfied = unsatisfied
+        avoidance = self.reservations.avoidance
+        copy_state.conflicts = 0 if avoidance is None else self.conflicts + avoidance.count(copy_state.g, copy_agents, copy_boxes)
+
+        # Constraint checks are lookups in the reservation table at the child's time step
+        blocked = self.reservations.agent_cells.get(copy_state.g)
+        if blocked is not None and copy_agents[0] in blocked:
+            copy_state.constraint_step = True
+        blocked = self.reservations.box_cells.get(copy_state.g)
+        if blocked is not None and any(copy_state.box_at(cell) is not None for cell in blocked):
+            copy_state.constraint_step = True
+
+        copy_state.time = min(copy_state.g, self.reservations.horizon)
+        if copy_state.time != self.time:
+            if copy_state.time >= len(State.time_keys):
+                State.extend_time_keys(copy_state.time)
+            copy_hash ^= State.time_keys[self.time] ^ State.time_keys[copy_state.time]
+        copy_state._hash = copy_hash
+        copy_state._atoms = None
 
         return copy_state
-    
+
+    @staticmethod
+    def move_box(boxes, from_cell, to_cell) -> '(tuple, char)':
+        # Copy the box tuple with one box moved, keeping it sorted so equal configurations compare equal
+        copy_boxes = list(boxes)
+        for index, (cell, box) in enumerate(copy_boxes):
+            if cell == from_cell:
+                del copy_boxes[index]
+                insort(copy_boxes, (to_cell, box))
+                return tuple(copy_boxes), box
+
     def is_goal_state(self) -> 'bool':
-        
-        for row in range(len(self.goals)):
-            for col in range(len(self.goals[row])):
-                goal = self.goals[row][col]
-                if 'A' <= goal <= 'Z' and self.boxes[row][col] != goal:
-                    return False
-                elif '0' <= goal <= '9' and not (self.agent_rows[0] == row and self.agent_cols[0] == col):
-                    return False
-        return True
-    
+        return self.unsatisfied == 0
+
+    def count_unsatisfied(self) -> 'int':
+        # Goals of the worker not covered by a box of their letter (or by the agent), from scratch
+        boxes = dict(self.boxes)
+        count = 0
+        for cell, goal in State.goal_index[self.worker_name].items():
+            if 'A' <= goal <= 'Z' and boxes.get(cell) != goal:
+                count += 1
+            elif '0' <= goal <= '9' and not self.agents[0] == cell:
+                count += 1
+        return count
+
     def get_expanded_states(self) -> '[State, ...]':
-        num_agents = len(self.agent_rows)
-        
-        # Determine list of applicable action for each individual agent.
-        applicable_actions = [[action for action in Action if self.is_applicable(agent, action)] for agent in range(num_agents)]
+        num_agents = len(self.agents)
+
+        # Occupancy indices, built once per expansion
+        boxes = dict(self.boxes)
+        agents = set(self.agents)
+
+        # Determine list of applicable action for each individual agent, among the ones the walls allow from its cell.
+        applicable_actions = [[action for action, box_cell, free_cell in State.action_table[agent_cell]
+                               if (box_cell is None or box_cell in boxes) and (free_cell is None or (free_cell not in boxes and free_cell not in agents))]
+                              for agent_cell in self.agents]
         # Iterate over joint actions, check conflict and generate child states.
         joint_action = [None for _ in range(num_agents)]
         actions_permutation = [0 for _ in range(num_agents)]
@@ -115,10 +346,10 @@ class State:
         while True:
             for agent in range(num_agents):
                 joint_action[agent] = applicable_actions[agent][actions_permutation[agent]]
-            
+
             if not self.is_conflicting(joint_action):
                 expanded_states.append(self.result(joint_action))
-            
+
             # Advance permutation.
             done = False
             for agent in range(num_agents):
@@ -129,134 +360,124 @@ class State:
                     actions_permutation[agent] = 0
                     if agent == num_agents - 1:
                         done = True
-            
+
             # Last permutation?
             if done:
                 break
-        
+
         State._RNG.shuffle(expanded_states)
         return expanded_states
-    
+
     def is_applicable(self, agent: 'int', action: 'Action') -> 'bool':
-        agent_row = self.agent_rows[agent]
-        agent_col = self.agent_cols[agent]
-        
+        num_cols = State.num_cols
+        agent_cell = self.agents[agent]
+
         if action.type is ActionType.NoOp:
             return True
-            
+
         elif action.type is ActionType.Move:
-            destination_row = agent_row + action.agent_row_delta
-            destination_col = agent_col + action.agent_col_delta
-            return self.is_free(destination_row, destination_col, self.g + 1)
-        
+            destination = agent_cell + action.agent_row_delta * num_cols + action.agent_col_delta
+            return self.is_free(destination)
+
         elif action.type is ActionType.Push:
-            destination_row = agent_row + action.agent_row_delta
-            destination_col = agent_col + action.agent_col_delta
-            box_destination_row =  destination_row + action.box_row_delta
-            box_destination_col =  destination_col + action.box_col_delta
-            return self.boxes[destination_row][destination_col] != '' and self.is_free(box_destination_row, box_destination_col, self.g + 1)
-        
+            destination = agent_cell + action.agent_row_delta * num_cols + action.agent_col_delta
+            box_destination = destination + action.box_row_delta * num_cols + action.box_col_delta
+            return self.box_at(destination) is not None and self.is_free(box_destination)
+
         elif action.type is ActionType.Pull:
-            destination_row = agent_row + action.agent_row_delta
-            destination_col = agent_col + action.agent_col_delta
-            box_row =  agent_row  - action.box_row_delta
-            box_col =  agent_col - action.box_col_delta
-            return self.boxes[box_row][box_col] != '' and self.is_free(destination_row, destination_col, self.g + 1)
-                
+            destination = agent_cell + action.agent_row_delta * num_cols + action.agent_col_delta
+            box_cell = agent_cell - action.box_row_delta * num_cols - action.box_col_delta
+            return self.box_at(box_cell) is not None and self.is_free(destination)
+
     def is_conflicting(self, joint_action: '[Action, ...]') -> 'bool':
-        num_agents = len(self.agent_rows)
-        
-        destination_rows = [None for _ in range(num_agents)] # row of new cell to become occupied by action
-        destination_cols = [None for _ in range(num_agents)] # column of new cell to become occupied by action
-        box_rows = [None for _ in range(num_agents)] # current row of box moved by action
-        box_cols = [None for _ in range(num_agents)] # current column of box moved by action
-        
+        num_agents = len(self.agents)
+        num_cols = State.num_cols
+
+        destinations = [None for _ in range(num_agents)] # new cell to become occupied by action
+        box_cells = [None for _ in range(num_agents)] # current cell of box moved by action
+
         # Collect cells to be occupied and boxes to be moved.
         for agent in range(num_agents):
             action = joint_action[agent]
-            agent_row = self.agent_rows[agent]
-            agent_col = self.agent_cols[agent]
-            
+            agent_cell = self.agents[agent]
+
             if action.type is ActionType.NoOp:
                 pass
-            
+
             elif action.type is ActionType.Move:
-                destination_rows[agent] = agent_row + action.agent_row_delta
-                destination_cols[agent] = agent_col + action.agent_col_delta
-                box_rows[agent] = agent_row # Distinct dummy value.
-                box_cols[agent] = agent_col # Distinct dummy value.
-                    
+                destinations[agent] = agent_cell + action.agent_row_delta * num_cols + action.agent_col_delta
+                box_cells[agent] = agent_cell # Distinct dummy value.
+
         for a1 in range(num_agents):
             if joint_action[a1] is Action.NoOp:
                 continue
-            
+
             for a2 in range(a1 + 1, num_agents):
                 if joint_action[a2] is Action.NoOp:
                     continue
-                
+
                 # Moving into same cell?
-                if destination_rows[a1] == destination_rows[a2] and destination_cols[a1] == destination_cols[a2]:
+                if destinations[a1] == destinations[a2]:
                     return True
-                        
+
         return False
-    
-    def is_free(self, row: 'int', col: 'int', time:'int' = 0) -> 'bool':
-        if State.walls[row][col] or self.boxes[row][col] != '' or self.agent_at(row, col) is not None:
+
+    def is_free(self, cell: 'int') -> 'bool':
+        if State.wall_cells[cell] or self.box_at(cell) is not None or self.agent_at(cell) is not None:
             return False
         return True
-    
-    def agent_at(self, row: 'int', col: 'int') -> 'char':
-        for agent in range(len(self.agent_rows)):
-            if self.agent_rows[agent] == row and self.agent_cols[agent] == col:
+
+    def box_at(self, cell: 'int') -> 'char':
+        for box_cell, box in self.boxes:
+            if box_cell == cell:
+                return box
+        return None
+
+    def agent_at(self, cell: 'int') -> 'char':
+        for agent, agent_cell in enumerate(self.agents):
+            if agent_cell == cell:
                 return chr(agent + ord('0'))
         return None
-    
-    def extract_plan(self) -> '[Action, ...]':
+
+    def extract_plan(self) -> '([Action, ...], Trajectory)':
         plan = [None for _ in range(self.g)]
-        plan_repr = [None for _ in range(self.g + 1)]
+        atoms = [None for _ in range(self.g + 1)]
         state = self
         while state.joint_action is not None:
             plan[state.g - 1] = state.joint_action
-            plan_repr[state.g] = list(sorted(state.atoms))
+            atoms[state.g] = sorted(state.atoms)
             state = state.parent
         # state.joint_action is None. State should be state.parent of first joint_action
-        plan_repr[state.g] = list(sorted(state.atoms))
-        return plan, plan_repr
-    
+        atoms[state.g] = sorted(state.atoms)
+
+        # Sorted atoms put the agent first, then the boxes by letter and cell: one column per entity
+        atoms = np.array(atoms, dtype=np.int64)
+        entities, cells = np.divmod(atoms, State.num_cells)
+        rows, cols = np.divmod(cells, State.num_cols)
+        return plan, Trajectory(entities[0].astype(np.int16), np.stack((rows, cols), axis=-1).astype(np.int16))
+
     def __hash__(self):
-        if self._hash is None:
-            prime = 31
-            _hash = 1
-            _hash = _hash * prime + hash(tuple(self.agent_rows))
-            _hash = _hash * prime + hash(tuple(self.agent_cols))
-            _hash = _hash * prime + hash(tuple(State.agent_colors))
-            _hash = _hash * prime + hash(tuple(tuple(row) for row in self.boxes))
-            _hash = _hash * prime + hash(tuple(State.box_colors))
-            _hash = _hash * prime + hash(tuple(tuple(row) for row in self.goals))
-            _hash = _hash * prime + hash(tuple(tuple(row) for row in State.walls))
-            self._hash = _hash
+        # Zobrist hash of agents, boxes and time, maintained incrementally by result
         return self._hash
-    
+
     def __eq__(self, other):
         if self is other: return True
         if not isinstance(other, State): return False
-        if self.agent_rows != other.agent_rows: return False
-        if self.agent_cols != other.agent_cols: return False
-        if State.agent_colors != other.agent_colors: return False
-        if State.walls != other.walls: return False
+        if self.time != other.time: return False
+        if self.agents != other.agents: return False
         if self.boxes != other.boxes: return False
-        if State.box_colors != other.box_colors: return False
-        if self.goals != other.goals: return False
         return True
-    
+
     def __repr__(self):
         lines = []
-        for row in range(len(self.boxes)):
+        boxes = dict(self.boxes)
+        for row in range(State.num_rows):
             line = []
-            for col in range(len(self.boxes[row])):
-                if self.boxes[row][col] != '': line.append(self.boxes[row][col])
-                elif State.walls[row][col] is not None: line.append('+')
-                elif self.agent_at(row, col) is not None: line.append(self.agent_at(row, col))
+            for col in range(State.num_cols):
+                cell = row * State.num_cols + col
+                if cell in boxes: line.append(boxes[cell])
+                elif State.wall_cells[cell]: line.append('+')
+                elif self.agent_at(cell) is not None: line.append(self.agent_at(cell))
                 else: line.append(' ')
             lines.append(''.join(line))
-        return '\n'.join(lines)
\ No newline at end of file
+        return '\n'.join(lines)
@@ -0,0 +1,43 @@
+''' Array-backed trajectories, the paths stored in the CBS nodes and checked for conflicts '''
+
+import numpy as np
+
+class Trajectory:
+    '''
+    Positions of the entities of one worker at every time step. Column 0 is the agent, then the boxes
+    sorted by letter and cell at every step, so the letter of a column never changes.
+    '''
+    __slots__ = ('entities', 'positions', '_cells')
+
+    def __init__(self, entities: 'np.ndarray', positions: 'np.ndarray'):
+        self.entities = entities        # int16 header, entity id of every column: agent 0-9, box letter 10 + (A-Z)
+        self.positions = positions      # int16 array (T, entities, 2) of (row, col)
+        self._cells = None
+
+    @property
+    def agent(self) -> 'int':
+        return int(self.entities[0])
+
+    def box_name(self, column: 'int') -> 'str':
+        return chr(ord('A') + int(self.entities[column]) - 10)
+
+    def __len__(self):
+        return len(self.positions)
+
+    @staticmethod
+    def pad(array: 'np.ndarray', length: 'int') -> 'np.ndarray':
+        # A view when no padding is needed, otherwise the last step is repeated by indexing
+        if length <= len(array):
+            return array[:length]
+        steps = np.minimum(np.arange(length), len(array) - 1)
+        return array[steps]
+
+    def padded(self, length: 'int') -> 'np.ndarray':
+        return Trajectory.pad(self.positions, length)
+
+    def cells(self, length: 'int') -> 'np.ndarray':
+        ''' Positions packed into one int32 per entity and step (row << 16 | col), shape (length, entities) '''
+        if self._cells is None:
+            positions = self.positions.astype(np.int32)
+            self._cells = positions[:, :, 0] << 16 | positions[:, :, 1]
+        return Trajectory.pad(self._cells, length)
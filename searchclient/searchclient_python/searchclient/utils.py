@@ -14,19 +14,6 @@ class Worker:
         self.color = color
         self.constraints = None
 
-# Used in conflictmodule
-
-def match_length(arr1, arr2):
-
-    len_diff = abs(len(arr2) - len(arr1))
-    if len(arr1) < len(arr2):
-        last_value = arr1[-1]
-        arr1 += [last_value] * len_diff
-    elif len(arr2) < len(arr1):
-        last_value = arr2[-1]
-        arr2 += [last_value] * len_diff
-    return arr1, arr2
-
 # Used in heuristic 
 
 def manhattan(pos0, pos1):